@@ -8,13 +8,26 @@
 #
 ###############################################################################
 
+import os
 import sqlite3
 import time
-import json
-
-from qgis.core import (QgsCoordinateReferenceSystem, QgsFeatureRequest,
-                       QgsProject, QgsVectorFileWriter, QgsVectorLayer, 
-                       QgsCoordinateTransform, QgsWkbTypes)
+from collections import namedtuple
+from functools import lru_cache
+
+try:
+    import orjson
+    def _dumps(obj):
+        return orjson.dumps(obj).decode("utf-8")
+    _loads = orjson.loads
+except ImportError:
+    import json
+    def _dumps(obj):
+        return json.dumps(obj, ensure_ascii=False)
+    _loads = json.loads
+
+from osgeo import ogr
+from qgis.core import (Qgis, QgsCoordinateReferenceSystem, QgsFeatureRequest,
+                       QgsMessageLog, QgsProject, QgsVectorLayer, QgsWkbTypes)
 
 from qgis.utils import iface
 from qgis.PyQt.QtCore import QObject, pyqtSignal
@@ -25,11 +38,36 @@ from .layer_utils import get_feat_cnt_from_src
 from ...models.space_model import parse_copyright
 from ...models import SpaceConnectionInfo
 from ...utils import make_unique_full_path, make_fixed_full_path
+from ... import config
 from .style import LAYER_QML
 
 from ..common.signal import make_print_qgis
 print_qgis = make_print_qgis("layer")
 
+LayerRec = namedtuple("LayerRec", "geom_str idx vlayer")
+
+_LAYER_QML_DOM = QDomDocument()
+_LAYER_QML_DOM.setContent(LAYER_QML, True) # xyz_id non editable
+
+_CRS_4326_WKT = None
+def _crs_4326_wkt():
+    global _CRS_4326_WKT
+    if _CRS_4326_WKT is None:
+        _CRS_4326_WKT = QgsCoordinateReferenceSystem('EPSG:4326').toWkt()
+    return _CRS_4326_WKT
+
+def _normalize_geom_str(geom_str):
+    """ no geometry layer is keyed by None (as in parser), 
+    not by QgsWkbTypes.displayString: "NoGeometry"
+    """
+    return None if geom_str in (None, "", "NoGeometry") else geom_str
+
+@lru_cache(maxsize=32)
+def _geom_display_name(geom_str, no_geom):
+    return QgsWkbTypes.geometryDisplayString(
+        QgsWkbTypes.geometryType(
+        QgsWkbTypes.parseType(
+        geom_str))) if geom_str else no_geom
 
 
 class XYZLayer(object):
@@ -51,9 +89,14 @@ class XYZLayer(object):
         self.unique = unique or int(time.time() * 10)
         self._group_name = group_name
 
-        self.map_vlayer = dict()
+        self.layers = list() # list of LayerRec
+        self._layer_index = dict() # (geom_str, idx): LayerRec
         self.map_fields = dict()
         self.qgroups = dict()
+        self._meta_json = None
+        self._conn_json = None
+        self._name_prefix = None
+        self._fname = None
 
     @classmethod
     def load_from_qnode(cls, qnode):
@@ -62,25 +105,72 @@ class XYZLayer(object):
         tags = qnode.customProperty("xyz-hub-tags")
         unique = qnode.customProperty("xyz-hub-id")
         name = qnode.name()
-        meta = json.loads(meta)
-        conn_info = json.loads(conn_info)
+        meta = _loads(meta)
+        conn_info = _loads(conn_info)
         conn_info = SpaceConnectionInfo.from_dict(conn_info)
 
         obj = cls(conn_info, meta, tags=tags, unique=unique, group_name=name)
         obj.qgroups["main"] = qnode
-        for g in qnode.findGroups():
+        lst_groups = qnode.findGroups()
+        for g in lst_groups:
             obj.qgroups[g.name()] = g
+        if obj._load_layers_cache(qnode):
+            return obj
+        for g in lst_groups:
             lst_vlayers = [i.layer() for i in g.findLayers()]
             for vlayer in lst_vlayers:
-                geom_str = QgsWkbTypes.displayString(vlayer.wkbType())
-                obj.map_vlayer.setdefault(geom_str, list()).append(vlayer)
-                obj.map_fields.setdefault(geom_str, list()).append(vlayer.fields())
+                geom_str = _normalize_geom_str(
+                    QgsWkbTypes.displayString(vlayer.wkbType()))
+                lst_fields = obj.map_fields.setdefault(geom_str, list())
+                obj._add_layer(geom_str, vlayer, len(lst_fields))
+                lst_fields.append(vlayer.fields())
+        obj._save_layers_cache(qnode) # repair stale cache
                 
         return obj
 
+    def _load_layers_cache(self, qnode):
+        """ load vlayers from the layers cache of the group node,
+        returns False if cache is missing, malformed or stale
+        """
+        txt = qnode.customProperty("xyz-hub-layers-cache")
+        if not txt: return False
+        # only layers still inside the group tree are valid
+        map_node = dict((n.layerId(), n) for n in qnode.findLayers())
+        lst_layer = list()
+        next_idx = dict()
+        try:
+            for geom_str, idx, layer_id in _loads(txt):
+                geom_str = _normalize_geom_str(geom_str)
+                node = map_node.get(layer_id)
+                if node is None or node.layer() is None: return False
+                if idx != next_idx.get(geom_str, 0): return False
+                next_idx[geom_str] = idx + 1
+                lst_layer.append((geom_str, idx, node.layer()))
+        except (TypeError, ValueError):
+            return False
+        for geom_str, idx, vlayer in lst_layer:
+            self._add_layer(geom_str, vlayer, idx)
+            self.map_fields.setdefault(geom_str, list()).append(vlayer.fields())
+        return True
+
+    def _save_layers_cache(self, qnode):
+        qnode.setCustomProperty("xyz-hub-layers-cache", _dumps(
+            [(r.geom_str, r.idx, r.vlayer.id()) for r in self.layers]))
+
+    def invalidate_meta_cache(self):
+        """ must be called after meta, tags or conn_info is modified
+        """
+        self._meta_json = None
+        self._conn_json = None
+        self._invalidate_cached_names()
+
     def _save_meta_node(self, qnode):
-        qnode.setCustomProperty("xyz-hub", json.dumps(self.meta, ensure_ascii=False))
-        qnode.setCustomProperty("xyz-hub-conn", json.dumps(self.conn_info.to_dict(), ensure_ascii=False))
+        if self._meta_json is None:
+            self._meta_json = _dumps(self.meta)
+        if self._conn_json is None:
+            self._conn_json = _dumps(self.conn_info.to_dict())
+        qnode.setCustomProperty("xyz-hub", self._meta_json)
+        qnode.setCustomProperty("xyz-hub-conn", self._conn_json)
         qnode.setCustomProperty("xyz-hub-tags", self.tags)
         qnode.setCustomProperty("xyz-hub-id", self.get_id())
 
@@ -98,70 +188,72 @@ class XYZLayer(object):
             meta.setRights(lst_txt)
         vlayer.setMetadata(meta)
 
+    @property
+    def map_vlayer(self):
+        """ returns {geom_str: list_of_vlayer}, derived from layers
+        """
+        map_vlayer = dict()
+        for r in self.layers:
+            map_vlayer.setdefault(r.geom_str, list()).append(r.vlayer)
+        return map_vlayer
     def iter_layer(self):
-        for lst in self.map_vlayer.values():
-            for vlayer in lst:
-                yield vlayer
+        return (r.vlayer for r in self.layers)
     def has_layer(self, geom_str, idx):
-        return (
-            geom_str in self.map_vlayer and 
-            idx < len(self.map_vlayer[geom_str])
-            )
+        return (geom_str, idx) in self._layer_index
     def get_layer(self, geom_str, idx):
-        return self.map_vlayer[geom_str][idx]
+        return self._layer_index[(geom_str, idx)].vlayer
     def get_name(self):
         return self._group_name
+    def _invalidate_cached_names(self):
+        self._name_prefix = None
+        self._fname = None
+    def _get_name_prefix(self):
+        """
+        returns "{title}-{id}{tags}", shared by group and vlayer names
+        """
+        if self._name_prefix is None:
+            tags = "-(%s)" %(self.tags) if len(self.tags) else ""
+            self._name_prefix = "{title}-{id}{tags}".format(
+                id=self.meta.get("id",""),
+                title=self.meta.get("title",""),
+                tags=tags,
+                )
+        return self._name_prefix
     def _make_group_name(self, idx=None):
         """
         returns main layer group name
         """
-        tags = "-(%s)" %(self.tags) if len(self.tags) else ""
-        temp = "{title}-{id}{tags}" if idx is None else "{title}-{id}{tags}-{idx}"
-        name = temp.format(
-            id=self.meta.get("id",""),
-            title=self.meta.get("title",""),
-            tags=tags, idx=idx,
-            )
-        return name
+        prefix = self._get_name_prefix()
+        return prefix if idx is None else "%s-%s"%(prefix, idx)
     def _group_geom_name(self, geom_str):
-        geom = QgsWkbTypes.geometryDisplayString(
-            QgsWkbTypes.geometryType(
-            QgsWkbTypes.parseType(
-            geom_str))) if geom_str else self.NO_GEOM
-        return geom 
+        return _geom_display_name(geom_str, self.NO_GEOM)
     def _layer_name(self, geom_str, idx):
         """
         returns vlayer name shown in qgis
         """
-        tags = "-(%s)" %(self.tags) if len(self.tags) else ""
-        return "{title}-{id}{tags}-{geom}-{idx}".format(
-            id=self.meta.get("id",""),
-            title=self.meta.get("title",""),
-            geom=geom_str, idx=idx, tags=tags,
-            )
+        return "%s-%s-%s"%(self._get_name_prefix(), geom_str, idx)
     def _db_layer_name(self, geom_str, idx):
         """
         returns name of the table corresponds to vlayer in sqlite db
         """
-        return "{geom}_{idx}".format(geom=geom_str, idx=idx)
+        return "%s_%s"%(geom_str, idx)
     def _layer_fname(self):
         """
         returns file name of the sqlite db corresponds to xyz layer
         """
-        tags = self.tags.replace(",","_") if len(self.tags) else ""
-        return "{id}_{tags}_{unique}".format(
-            id=self.meta.get("id",""),
-            tags=tags, unique=self.unique,
-            )
+        if self._fname is None:
+            tags = self.tags.replace(",","_") if len(self.tags) else ""
+            self._fname = "{id}_{tags}_{unique}".format(
+                id=self.meta.get("id",""),
+                tags=tags, unique=self.unique,
+                )
+        return self._fname
     def get_id(self):
         return self.unique
     def get_map_fields(self):
         return self.map_fields
     def get_feat_cnt(self):
-        cnt = 0
-        for vlayer in self.iter_layer():
-            cnt += get_feat_cnt_from_src(vlayer)
-        return cnt
+        return sum(get_feat_cnt_from_src(r.vlayer) for r in self.layers)
     def add_empty_group(self):
         tree_root = QgsProject.instance().layerTreeRoot()
         group = self.qgroups.get("main")
@@ -177,46 +269,65 @@ class XYZLayer(object):
             self._save_meta_node(group)
         return group
     def add_ext_layer(self, geom_str, idx):
-        crs = QgsCoordinateReferenceSystem('EPSG:4326').toWkt()
-
-        vlayer = self._init_ext_layer(geom_str, idx, crs)
-        self._add_layer(geom_str, vlayer, idx)
+        return self.add_ext_layers([(geom_str, idx)])[0]
+    def add_ext_layers(self, lst_geom_idx):
+        """ add several vlayers at once, gpkg tables are created 
+        in one transaction
+        :lst_geom_idx: list of (geom_str, idx), idx ascending per geom_str
+        """
+        if not lst_geom_idx: return list()
+        self._check_new_layers(lst_geom_idx) # before any I/O
+        crs = _crs_4326_wkt()
 
-        dom = QDomDocument()
-        dom.setContent(LAYER_QML, True) # xyz_id non editable
-        vlayer.importNamedStyle(dom)
+        lst_vlayer = self._init_ext_layers(lst_geom_idx, crs)
 
-        QgsProject.instance().addMapLayer(vlayer, False)
+        # 1 layersAdded signal for the whole batch
+        QgsProject.instance().addMapLayers(lst_vlayer, False)
 
         group = self.add_empty_group()
 
+        for (geom_str, idx), vlayer in zip(lst_geom_idx, lst_vlayer):
+            self._add_layer(geom_str, vlayer, idx)
+            group_geom = self._get_geom_group(group, geom_str)
+            group_geom.addLayer(vlayer)
+        self._save_layers_cache(group)
+        
+        if iface: iface.setActiveLayer(lst_vlayer[-1])
+        return lst_vlayer
+    def _check_new_layers(self, lst_geom_idx):
+        """ ensure new (geom_str, idx) follow existing layers without gap
+        """
+        next_idx = dict()
+        for geom_str, idx in lst_geom_idx:
+            expected = next_idx.get(geom_str)
+            if expected is None:
+                expected = sum(1 for r in self.layers if r.geom_str == geom_str)
+            assert idx == expected, "vlayer count mismatch"
+            next_idx[geom_str] = expected + 1
+    def _get_geom_group(self, group, geom_str):
         geom = self._group_geom_name(geom_str)
-        order = self.GEOM_ORDER.get(geom)
         group_geom = self.qgroups.get(geom)
-        group_geom = group_geom or (
-            group.insertGroup(order,geom)
-            if order is not None else 
-            group.addGroup(geom)
-        )
-        self.qgroups[geom] = group_geom
-
-        group_geom.addLayer(vlayer)
-        
-        if iface: iface.setActiveLayer(vlayer)
-        return vlayer
+        if group_geom is None:
+            order = self.GEOM_ORDER.get(geom)
+            group_geom = (
+                group.insertGroup(order,geom)
+                if order is not None else 
+                group.addGroup(geom)
+            )
+            self.qgroups[geom] = group_geom
+        return group_geom
     def _add_layer(self, geom_str, vlayer, idx):
-        lst = self.map_vlayer.setdefault(geom_str, list())
-        assert idx == len(lst), "vlayer count mismatch"
-        lst.append(vlayer)
-
-    def _init_ext_layer(self, geom_str, idx, crs):
-        """ given non map of feat, init a qgis layer
-        :map_feat: {geom_string: list_of_feat}
+        assert not self.has_layer(geom_str, idx) and (
+            idx == 0 or self.has_layer(geom_str, idx - 1)
+            ), "vlayer count mismatch"
+        rec = LayerRec(geom_str, idx, vlayer)
+        self.layers.append(rec)
+        self._layer_index[(geom_str, idx)] = rec
+
+    def _init_ext_layers(self, lst_geom_idx, crs):
+        """ given list of (geom_str, idx), init qgis layers
         """
         ext=self.ext
-        driver_name = ext.upper() # might not needed for 
-
-        layer_name = self._layer_name(geom_str, idx)
         
         # sqlite max connection 64
         # if xyz space -> more than 64 vlayer,
@@ -224,85 +335,145 @@ class XYZLayer(object):
         
         # fname = make_unique_full_path(ext=ext)
         fname = make_fixed_full_path(self._layer_fname(),ext=ext)
-        
-        vlayer = QgsVectorLayer(
-            "{geom}?crs={crs}&index=yes".format(geom=geom_str,crs=crs), 
-            layer_name,"memory") # this should be done in main thread
-
-        # QgsVectorFileWriter.writeAsVectorFormat(vlayer, fname, "UTF-8", vlayer.sourceCrs(), driver_name)
-
-        db_layer_name = self._db_layer_name(geom_str, idx)
-
-        options = QgsVectorFileWriter.SaveVectorOptions()
-        options.fileEncoding = "UTF-8"
-        options.driverName = driver_name
-        options.ct = QgsCoordinateTransform(vlayer.sourceCrs(), vlayer.sourceCrs(), QgsProject.instance())
-        options.layerName = db_layer_name
-        options.actionOnExistingFile = QgsVectorFileWriter.CreateOrOverwriteLayer # update mode
-        err=QgsVectorFileWriter.writeAsVectorFormat(vlayer, fname, options)
-        if err[0] == QgsVectorFileWriter.ErrCreateDataSource : 
-            options.actionOnExistingFile = QgsVectorFileWriter.CreateOrOverwriteFile
-            err=QgsVectorFileWriter.writeAsVectorFormat(vlayer, fname, options)
-        if err[0] != QgsVectorFileWriter.NoError:
-            raise Exception("%s: %s"%err)
-        
+
         sql_constraint = '"%s" TEXT UNIQUE ON CONFLICT REPLACE'%(parser.QGS_XYZ_ID) # replace older duplicate
         # sql_constraint = '"%s" TEXT UNIQUE ON CONFLICT IGNORE'%(parser.QGS_XYZ_ID) # discard newer duplicate
-        self._init_constraint(fname, sql_constraint, db_layer_name)
+        lst_table = [
+            (self._db_layer_name(geom_str, idx), geom_str)
+            for geom_str, idx in lst_geom_idx]
+        self._init_gpkg_tables(fname, lst_table, crs, sql_constraint)
+        self._create_spatial_indexes(fname,
+            [layer_name for layer_name, geom_str in lst_table if geom_str])
+
+        return [
+            self._build_ext_layer(fname, db_layer_name, geom_str, idx)
+            for (db_layer_name, geom_str), (_, idx) in zip(lst_table, lst_geom_idx)
+        ]
 
+    def _build_ext_layer(self, fname, db_layer_name, geom_str, idx):
+        """ returns styled vlayer of an existing gpkg table,
+        vlayer is not added to project
+        """
+        layer_name = self._layer_name(geom_str, idx)
         uri = "%s|layername=%s"%(fname, db_layer_name)
         vlayer = QgsVectorLayer(uri, layer_name, "ogr")
+        vlayer.importNamedStyle(_LAYER_QML_DOM)
         self._save_meta(vlayer)
-        
         return vlayer
 
-    def _init_constraint(self, fname, sql_constraint, layer_name):
-        # https://sqlite.org/lang_altertable.html
-
-        tmp_name = "tmp_" + layer_name
-
+    def _create_spatial_indexes(self, fname, lst_layer_name):
+        """ create rtree of the gpkg tables, through 1 ogr datasource per batch
+        """
+        if not lst_layer_name: return
+        ds = ogr.Open(fname, 1)
+        lst_failed = list(lst_layer_name)
+        if ds is not None:
+            lst_failed = list()
+            for layer_name in lst_layer_name:
+                res = ds.ExecuteSQL("SELECT CreateSpatialIndex('%s', 'geom')"%(layer_name))
+                if res is not None: ds.ReleaseResultSet(res)
+                lyr = ds.GetLayerByName(layer_name)
+                if lyr is None or not lyr.TestCapability(ogr.OLCFastSpatialFilter):
+                    lst_failed.append(layer_name)
+            ds = None # flush and close
+        for layer_name in lst_failed:
+            QgsMessageLog.logMessage(
+                "No spatial index created for layer: %s|layername=%s"%(fname, layer_name),
+                config.TAG_PLUGIN, Qgis.Warning)
+
+    def _open_gpkg(self, fname):
+        """ returns a new sqlite connection of the gpkg,
+        the gpkg is created if not existed
+        """
+        if not os.path.exists(fname):
+            ds = ogr.GetDriverByName("GPKG").CreateDataSource(fname)
+            if ds is None:
+                raise Exception("Cannot create GPKG: %s"%(fname))
+            ds = None # flush and close
         conn = sqlite3.connect(fname)
-        cur = conn.cursor()
+        conn.isolation_level = None # autocommit, transaction is managed in script
+        return conn
+
+    def _init_gpkg_tables(self, fname, lst_table, crs, sql_constraint):
+        """ create (or overwrite) empty gpkg tables with constraint
+        in one transaction, so tables do not need to be rebuilt afterward.
+        Overwrite is not atomic: existing tables are deleted through ogr
+        before the transaction, a failed create does not restore them.
+        http://www.geopackage.org/spec/#_contents
+        :lst_table: list of (layer_name, geom_str)
+        """
+        srs_id = 4326
 
-        sql = 'SELECT type, sql FROM sqlite_master WHERE tbl_name="%s"'%(layer_name)
-        cur.execute(sql)
-        lst = cur.fetchall()
-        if len(lst) == 0:
-            raise Exception("No layer found in GPKG")
-        lst_old_sql = [p[1] for p in lst]
-        sql_create = lst_old_sql.pop(0)
-
-        sql_create = sql_create.replace(layer_name, tmp_name)
-        parts = sql_create.partition(")")
-        sql_create = "".join([
-            parts[0], 
-            ", %s"%(sql_constraint), 
-            parts[1], parts[2]
-        ])
-        # empty table, so insert is skipped
         lst_sql = [
-            "PRAGMA foreign_keys = '0'",
             "BEGIN TRANSACTION",
-            sql_create,
-            "PRAGMA defer_foreign_keys = '1'",
-            'DROP TABLE "%s"'%(layer_name),
-            'ALTER TABLE "%s" RENAME TO "%s"'%(tmp_name, layer_name),
-            "PRAGMA defer_foreign_keys = '0'"
-        ] + lst_old_sql + [
-            # 'PRAGMA "main".foreign_key_check', # does not return anything -> unused
-            "COMMIT",
-            "PRAGMA foreign_keys = '1'"
+            (
+                "INSERT OR IGNORE INTO gpkg_spatial_ref_sys "
+                "(srs_name, srs_id, organization, organization_coordsys_id, definition) "
+                "VALUES ('WGS 84 geodetic', %s, 'EPSG', %s, '%s')"
+            )%(srs_id, srs_id, crs.replace("'", "''")),
         ]
-        for s in lst_sql:
-            if "COMMIT" in s:
-                conn.commit()
-                continue
-            # if "COMMIT" in s and not conn.in_transaction: continue
+        for layer_name, geom_str in lst_table:
+            lst_sql.extend(self._make_gpkg_table_sql(
+                layer_name, geom_str, srs_id, sql_constraint))
+        lst_sql.append("COMMIT")
 
-            cur.execute(s)
+        # 1 connection per batch, closed before the vlayers open the gpkg
+        conn = self._open_gpkg(fname)
+        cur = conn.cursor()
+        try:
+            lst_name = [layer_name for layer_name, _ in lst_table]
+            cur.execute(
+                "SELECT table_name FROM gpkg_contents WHERE table_name IN (%s)"%(
+                    ", ".join("?" for _ in lst_name)),
+                lst_name)
+            lst_existed = [layer_name for (layer_name,) in cur.fetchall()]
+            if lst_existed:
+                self._delete_gpkg_layers(fname, lst_existed)
+
+            cur.executescript(";\n".join(lst_sql) + ";")
+        except Exception:
+            if conn.in_transaction: conn.rollback()
+            raise
+        finally:
+            cur.close()
+            conn.close()
+
+    def _make_gpkg_table_sql(self, layer_name, geom_str, srs_id, sql_constraint):
+        geom_type = geom_str.upper() if geom_str else None
+
+        lst_col = ['"fid" INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL']
+        if geom_type:
+            lst_col.append('"geom" %s'%(geom_type))
+        lst_col.append(sql_constraint)
 
-        conn.commit()
-        conn.close()
+        lst_sql = [
+            'CREATE TABLE "%s" (%s)'%(layer_name, ", ".join(lst_col)),
+            (
+                "INSERT INTO gpkg_contents (table_name, data_type, identifier, srs_id) "
+                "VALUES ('%s', '%s', '%s', %s)"
+            )%(layer_name, "features" if geom_type else "attributes", layer_name, srs_id),
+        ]
+        if geom_type:
+            lst_sql.append((
+                "INSERT INTO gpkg_geometry_columns "
+                "(table_name, column_name, geometry_type_name, srs_id, z, m) "
+                "VALUES ('%s', 'geom', '%s', %s, 0, 0)"
+            )%(layer_name, geom_type, srs_id))
+        return lst_sql
+
+    def _delete_gpkg_layers(self, fname, lst_layer_name):
+        """ delete layers and their gpkg metadata (spatial index, extensions)
+        through 1 ogr datasource
+        """
+        ds = ogr.Open(fname, 1)
+        if ds is None:
+            raise Exception("Cannot open GPKG: %s"%(fname))
+        names = set(lst_layer_name)
+        lst_idx = [i for i in range(ds.GetLayerCount())
+            if ds.GetLayerByIndex(i).GetName() in names]
+        for i in reversed(lst_idx): # deleting shifts later indices
+            ds.DeleteLayer(i)
+        ds = None # flush and close
 
 
 """ Available vector format for QgsVectorFileWriter
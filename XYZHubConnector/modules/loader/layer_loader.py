@@ -170,16 +170,22 @@ class LoadLayerController(BaseLoader):
     # non-threaded
     def _render(self, *parsed_feat):
         map_feat, map_fields = parsed_feat
+        self._add_missing_layers(map_feat)
         for geom in map_feat.keys():
             for idx, (feat, fields) in enumerate(
             zip(map_feat[geom], map_fields[geom])):
                 if not feat: continue
-                if not self.layer.has_layer(geom, idx):
-                    vlayer=self.layer.add_ext_layer(geom, idx)
-                else:
-                    vlayer=self.layer.get_layer(geom, idx)
+                vlayer=self.layer.get_layer(geom, idx)
                 render.add_feature_render(vlayer, feat, fields)
 
+    def _add_missing_layers(self, map_feat):
+        lst_geom_idx = [(geom, idx)
+            for geom, lst_feat in map_feat.items()
+            for idx, feat in enumerate(lst_feat)
+            if feat and not self.layer.has_layer(geom, idx)
+        ]
+        self.layer.add_ext_layers(lst_geom_idx)
+
     def get_feat_cnt(self):
         return self.layer.get_feat_cnt()
 
@@ -211,6 +217,7 @@ class LoadLayerController(BaseLoader):
     #threaded (parallel)
     def _dispatch_render(self, *parsed_feat):
         map_feat, map_fields = parsed_feat
+        self._add_missing_layers(map_feat)
         lst_args = [(geom, idx, feat, fields) 
             for geom in map_feat.keys()
             for idx, (feat, fields) in enumerate(zip(
@@ -220,10 +227,8 @@ class LoadLayerController(BaseLoader):
 
         return lst_args
     def _render_single(self, geom, idx, feat, fields):
-        if not self.layer.has_layer(geom, idx):
-            vlayer=self.layer.add_ext_layer(geom, idx)
-        else:
-            vlayer=self.layer.get_layer(geom, idx)
+        # vlayer is created in _dispatch_render
+        vlayer=self.layer.get_layer(geom, idx)
         render.add_feature_render(vlayer, feat, fields)
 
 class TileLayerLoader(LoadLayerController):
@@ -13,6 +13,7 @@
 
 import gzip
 import json
+from functools import lru_cache
 from qgis.PyQt.QtCore import QUrl
 from qgis.PyQt.QtNetwork import QNetworkRequest
 from qgis.PyQt.QtCore import QVariant
@@ -94,6 +95,13 @@ HEADER_EXTRA_MAP = dict(
     json={"Content-Type": "application/json"},
     gzip={"Accept-Encoding": "gzip"}
 )
+@lru_cache(maxsize=32)
+def _make_request_template(token, req_type):
+    """Request with headers pre-set, shared by all requests 
+    of the same token and req_type (url is set per request)
+    """
+    header = HEADER_EXTRA_MAP.get(req_type,dict())
+    return make_request(QUrl(), token, **header)
 def make_conn_request(conn_info, endpoint, req_type="normal", **kw):
     """Make request from conn_info (token,space_id,api_url, auth,etc.) 
     :param: req_type: type of request:
@@ -107,8 +115,9 @@ def make_conn_request(conn_info, endpoint, req_type="normal", **kw):
     api_url = API_URL[conn_info.server]
     url = api_url + endpoint.format(space_id=space_id)
     url = make_query_url(url, **kw)
-    header = HEADER_EXTRA_MAP.get(req_type,dict())
-    return make_request(url, token, **header)
+    request = QNetworkRequest(_make_request_template(token, req_type)) # copy
+    request.setUrl(url)
+    return request
 
 ##########################################
 # data flow in reply (QNetworkReply)
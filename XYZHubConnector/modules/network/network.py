@@ -10,33 +10,61 @@
 
 
 from qgis.PyQt.QtCore import QObject, QTimer
-from qgis.PyQt.QtNetwork import QNetworkAccessManager
+from qgis.PyQt.QtNetwork import QNetworkAccessManager, QNetworkRequest
 
 from .net_utils import make_conn_request, set_qt_property, prepare_new_space_info, make_payload, make_buffer
 
 TIMEOUT_COUNT = 1000
+READ_TIMEOUT = TIMEOUT_COUNT * 30 # abort stalled GET after 30s without data
+N_NETWORK = 4 # each network access manager has its own connection pool
 
 ##########
 
 class NetManager(QObject):
     def __init__(self, parent):
         super().__init__(parent)
-        self.network = QNetworkAccessManager(self)
+        self.networks = [QNetworkAccessManager(self) for _ in range(N_NETWORK)]
+        self.network = self.networks[0]
+
+    def _pick_network(self, key):
+        """ returns network access manager sharded by key, 
+        to get more parallel connections to the same host
+        """
+        if key is None: return self.network
+        return self.networks[hash(key) % len(self.networks)]
 
     #############
-    def _pre_send_request(self,conn_info, endpoint, kw_request=dict()):
+    def _pre_send_request(self,conn_info, endpoint, kw_request=None):
         assert(isinstance(endpoint,str))
-        request = make_conn_request(conn_info, endpoint,**kw_request)
+        request = make_conn_request(conn_info, endpoint,**(kw_request or {}))
+        # multiplex requests to the same host over 1 connection
+        request.setAttribute(QNetworkRequest.Http2AllowedAttribute, True)
+        request.setAttribute(QNetworkRequest.HttpPipeliningAllowedAttribute, True)
         return request
 
-    def _post_send_request(self, reply, conn_info, kw_prop=dict()):
-        set_qt_property(reply, conn_info=conn_info, **kw_prop)
+    def _post_send_request(self, reply, conn_info, kw_prop=None):
+        set_qt_property(reply, conn_info=conn_info, **(kw_prop or {}))
 
-    def _send_request(self,conn_info, endpoint, kw_request=dict(), kw_prop=dict()):
+    def _send_request(self,conn_info, endpoint, kw_request=None, kw_prop=None, timeout=None, shard_key=None):
+        """ GET request
+        timeout: abort request after timeout (ms)
+        shard_key: hashable key to pick the network access manager
+        """
         
         request = self._pre_send_request(conn_info,endpoint,kw_request=kw_request)
-
-        reply = self.network.get(request)
+        if kw_prop and kw_prop.get("reply_tag") == "tile":
+            request.setPriority(QNetworkRequest.HighPriority)
+        has_transfer_timeout = hasattr(request, "setTransferTimeout") # Qt >= 5.15
+        if has_transfer_timeout:
+            # abort stalled replies so they do not pile up.
+            # replies are not auto-deleted: they are read in worker threads 
+            # after finished and deleted in net_handler.
+            # not applied to write requests (upload may take long to respond)
+            request.setTransferTimeout(timeout or READ_TIMEOUT)
+
+        reply = self._pick_network(shard_key).get(request)
+        if timeout and not has_transfer_timeout:
+            QTimer.singleShot(timeout, reply.abort)
 
         self._post_send_request(reply,conn_info, kw_prop=kw_prop)
         return reply
@@ -44,9 +72,7 @@ class NetManager(QObject):
     #############
     # TODO: remove callback params
     def get_statistics(self, conn_info):
-        reply = self._get_space_(conn_info, "statistics")
-        timeout = TIMEOUT_COUNT
-        QTimer.singleShot(timeout, reply.abort)
+        reply = self._get_space_(conn_info, "statistics", timeout=TIMEOUT_COUNT)
         return reply
     def get_count(self, conn_info):
         reply = self._get_space_(conn_info, "count")
@@ -54,13 +80,12 @@ class NetManager(QObject):
     def get_meta(self, conn_info):
         return self._get_space_(conn_info, "space_meta")
 
-    def _get_space_(self, conn_info, reply_tag):
+    def _get_space_(self, conn_info, reply_tag, timeout=None):
         tag = "/" + reply_tag if reply_tag != "space_meta" else ""
         
         endpoint = "/spaces/{space_id}" + tag
-        kw_request = dict()
         kw_prop = dict(reply_tag=reply_tag)
-        return self._send_request(conn_info, endpoint, kw_request=kw_request, kw_prop=kw_prop)
+        return self._send_request(conn_info, endpoint, kw_prop=kw_prop, timeout=timeout)
         
     def list_spaces(self, conn_info):
         endpoint = "/spaces"
@@ -97,10 +122,9 @@ class NetManager(QObject):
     def del_space(self, conn_info):
         
         endpoint = "/spaces/{space_id}"
-        kw_request = dict()
         kw_prop = dict(reply_tag="del_space")
 
-        request = self._pre_send_request(conn_info,endpoint,kw_request=kw_request)
+        request = self._pre_send_request(conn_info,endpoint)
         reply = self.network.sendCustomRequest(request, b"DELETE")
 
         self._post_send_request(reply,conn_info, kw_prop=kw_prop)
@@ -115,15 +139,16 @@ class NetManager(QObject):
         kw_prop = dict(reply_tag="bbox")
         kw_prop.update(kw)
         kw_prop["bbox"] = bbox
+        shard_key = tuple(sorted(bbox.items()))
         
-        return self._send_request(conn_info, endpoint, kw_request=kw_request, kw_prop=kw_prop)
+        return self._send_request(conn_info, endpoint, kw_request=kw_request, kw_prop=kw_prop, shard_key=shard_key)
 
     def load_features_tile(self, conn_info, tile_id="0", tile_schema="quadkey", **kw):
         reply_tag = "tile"
         tile_url = "tile/{tile_schema}/{tile_id}".format(
             tile_schema=tile_schema, tile_id=tile_id)
         endpoint = "/spaces/{space_id}/" + tile_url
-        return self._load_features_endpoint(endpoint, conn_info, reply_tag=reply_tag, **kw)
+        return self._load_features_endpoint(endpoint, conn_info, reply_tag=reply_tag, shard_key=tile_id, **kw)
 
     def load_features_iterate(self, conn_info, **kw_iterate):
         reply_tag = kw_iterate.pop("reply_tag","iterate")
@@ -135,14 +160,12 @@ class NetManager(QObject):
         endpoint = "/spaces/{space_id}/search"
         return self._load_features_endpoint(endpoint, conn_info, reply_tag=reply_tag, **kw_iterate)
         
-    def _load_features_endpoint(self, endpoint, conn_info, reply_tag=None, **kw_iterate):
+    def _load_features_endpoint(self, endpoint, conn_info, reply_tag=None, shard_key=None, **kw_iterate):
         """ Iterate through all ordered features (no feature is repeated twice)
         """
-        kw_request = dict(kw_iterate)
-        kw_prop = dict(reply_tag=reply_tag)
-        kw_prop.update(kw_iterate)
+        kw_prop = dict(kw_iterate, reply_tag=reply_tag)
         
-        return self._send_request(conn_info, endpoint, kw_request=kw_request, kw_prop=kw_prop)
+        return self._send_request(conn_info, endpoint, kw_request=kw_iterate, kw_prop=kw_prop, shard_key=shard_key)
 
     ###### feature function
     def add_features(self, conn_info, added_feat, **kw):
@@ -172,14 +195,13 @@ class NetManager(QObject):
     def del_features(self, conn_info, removed_feat, **kw):
         # DELETE by Query URL, required list of feat_id
 
-        query_del = {"id": ",".join(str(i) for i in removed_feat)}
+        query_del = {"id": ",".join(map(str, removed_feat))}
         kw.update(query_del)
 
         endpoint = "/spaces/{space_id}/features"
-        kw_request = dict(kw) # kw: query
         kw_prop = dict(reply_tag="del_feat")
 
-        request = self._pre_send_request(conn_info,endpoint,kw_request=kw_request)
+        request = self._pre_send_request(conn_info,endpoint,kw_request=kw) # kw: query
     
         reply = self.network.sendCustomRequest(request, b"DELETE")
         self._post_send_request(reply, conn_info, kw_prop=kw_prop)
@@ -182,8 +182,9 @@ if __name__ == "__main__":
 
     counter = Counter(total, loop.quit)
 
-    network.network.finished.connect(validator.check_reply)
-    network.network.finished.connect(counter.count_reply)
+    for nam in network.networks: # tile requests are sharded
+        nam.finished.connect(validator.check_reply)
+        nam.finished.connect(counter.count_reply)
 
     for i,params in enumerate(lst_params):
         network.load_features_tile(conn_info, **params)
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+###############################################################################
+#
+# Copyright (c) 2019 HERE Europe B.V.
+#
+# SPDX-License-Identifier: MIT
+# License-Filename: LICENSE
+#
+###############################################################################
+
+import os
+import random
+import sqlite3
+
+from test.utils import BaseTestAsync
+from qgis.testing import unittest
+from qgis.core import (QgsFeature, QgsGeometry, QgsPointXY, QgsProject,
+                       QgsWkbTypes)
+
+from XYZHubConnector.models import SpaceConnectionInfo
+from XYZHubConnector.modules.layer import XYZLayer, parser
+from XYZHubConnector.modules.loader import LoadLayerController
+from XYZHubConnector.modules.network import NetManager
+
+
+class TestXYZLayer(BaseTestAsync):
+    """ test gpkg tables created by XYZLayer (no network)
+    """
+    LST_GEOM_IDX = [("Point", 0), ("Point", 1), ("LineString", 0),
+        ("Polygon", 0), (None, 0)]
+    def setUp(self):
+        super().setUp()
+        self.layer = self.new_layer()
+    def tearDown(self):
+        self.remove_layer(self.layer)
+        super().tearDown()
+
+    def test_create_gpkg_table(self):
+        vlayer = self.layer.add_ext_layer("Point", 0)
+        self.assertTrue(vlayer.isValid())
+        self.assertEqual(vlayer.providerType(), "ogr")
+        self.assertEqual(vlayer.wkbType(), QgsWkbTypes.Point)
+        self.assertIn(parser.QGS_XYZ_ID, vlayer.fields().names())
+        self.assertTrue(self.layer.has_layer("Point", 0))
+        self.assertIs(self.layer.get_layer("Point", 0), vlayer)
+
+    def test_duplicate_xyz_id_replaced(self):
+        vlayer = self.layer.add_ext_layer("Point", 0)
+        self._add_feat(vlayer, ["a", "b", "a"])
+        self.assertEqual(self._get_xyz_ids(vlayer), ["a", "b"])
+
+    def test_overwrite_gpkg_table(self):
+        vlayer = self.layer.add_ext_layer("Point", 0)
+        self._add_feat(vlayer, ["a", "b"])
+        unique = self.layer.unique
+        self.remove_layer(self.layer)
+
+        # same unique, same gpkg file: existing table is dropped and recreated
+        self.layer = self.new_layer(unique)
+        vlayer = self.layer.add_ext_layer("Point", 0)
+        self.assertTrue(vlayer.isValid())
+        self.assertEqual(vlayer.wkbType(), QgsWkbTypes.Point)
+        self.assertEqual(self._get_xyz_ids(vlayer), [])
+        self._add_feat(vlayer, ["c", "c"])
+        self.assertEqual(self._get_xyz_ids(vlayer), ["c"])
+
+    def test_overwrite_gpkg_tables_batch(self):
+        lst_vlayer = self.layer.add_ext_layers(self.LST_GEOM_IDX)
+        self._add_feat(lst_vlayer[0], ["a", "b"])
+        self._add_feat(lst_vlayer[-1], ["a"], with_geom=False)
+        unique = self.layer.unique
+        self.remove_layer(self.layer)
+
+        self.layer = self.new_layer(unique)
+        lst_vlayer = self.layer.add_ext_layers(self.LST_GEOM_IDX)
+        for vlayer in lst_vlayer:
+            self.assertTrue(vlayer.isValid())
+            self.assertEqual(self._get_xyz_ids(vlayer), [])
+        self.assertEqual(self._get_gpkg_tables(lst_vlayer[0]), sorted(
+            self.layer._db_layer_name(g, i) for g, i in self.LST_GEOM_IDX))
+
+    def test_no_geometry_table(self):
+        vlayer = self.layer.add_ext_layer(None, 0)
+        self.assertTrue(vlayer.isValid())
+        self.assertIn("layername=None_0", vlayer.source())
+        self.assertEqual(vlayer.wkbType(), QgsWkbTypes.NoGeometry)
+        self._add_feat(vlayer, ["a", "a"], with_geom=False)
+        self.assertEqual(self._get_xyz_ids(vlayer), ["a"])
+        self.assertIn(XYZLayer.NO_GEOM, self.layer.qgroups)
+
+    def test_add_ext_layers_batch(self):
+        lst_geom_idx = self.LST_GEOM_IDX
+        lst_added = list()
+        QgsProject.instance().layersAdded.connect(lst_added.append)
+        try:
+            lst_vlayer = self.layer.add_ext_layers(lst_geom_idx)
+        finally:
+            QgsProject.instance().layersAdded.disconnect(lst_added.append)
+
+        self.assertEqual(len(lst_added), 1, "layersAdded emitted once per batch")
+        self.assertEqual(len(lst_added[0]), len(lst_geom_idx))
+        self.assertEqual(len(lst_vlayer), len(lst_geom_idx))
+        for (geom_str, idx), vlayer in zip(lst_geom_idx, lst_vlayer):
+            self.assertTrue(vlayer.isValid())
+            self.assertIs(self.layer.get_layer(geom_str, idx), vlayer)
+            self.assertIs(QgsProject.instance().mapLayer(vlayer.id()), vlayer)
+
+        tables = self._get_gpkg_tables(lst_vlayer[0])
+        self.assertEqual(tables, sorted(
+            self.layer._db_layer_name(g, i) for g, i in lst_geom_idx))
+        indexed = self._get_gpkg_tables(lst_vlayer[0],
+            "SELECT table_name FROM gpkg_extensions "
+            "WHERE extension_name = 'gpkg_rtree_index'")
+        self.assertEqual(indexed, sorted(
+            self.layer._db_layer_name(g, i) for g, i in lst_geom_idx if g))
+
+        for geom in ["Point", "Line", "Polygon", XYZLayer.NO_GEOM]:
+            self.assertIn(geom, self.layer.qgroups)
+        group_point = self.layer.qgroups["Point"]
+        self.assertEqual(len(group_point.findLayers()), 2)
+
+    def test_add_ext_layers_after_file_removed(self):
+        vlayer = self.layer.add_ext_layer("Point", 0)
+        os.remove(vlayer.source().split("|")[0]) # e.g. clear cache
+
+        # gpkg is recreated, no stale db handle is reused
+        vlayer = self.layer.add_ext_layer("Point", 1)
+        self.assertTrue(vlayer.isValid())
+        self.assertEqual(self._get_gpkg_tables(vlayer), ["Point_1"])
+
+    def test_add_ext_layers_invalid_order(self):
+        with self.assertRaises(AssertionError):
+            self.layer.add_ext_layers([("Point", 1)])
+        self.assertEqual(list(self.layer.iter_layer()), [])
+        self.assertNotIn("main", self.layer.qgroups)
+
+    def test_add_missing_layers(self):
+        con = LoadLayerController(NetManager(self.app))
+        con.layer = self.layer
+        self.layer.add_ext_layer("Point", 0)
+        map_feat = {"Point": [["ft"], ["ft"]], "LineString": [[]], None: [["ft"]]}
+        con._add_missing_layers(map_feat)
+
+        self.assertTrue(self.layer.has_layer("Point", 1))
+        self.assertTrue(self.layer.has_layer(None, 0))
+        self.assertFalse(self.layer.has_layer("LineString", 0))
+        self.assertEqual(len(list(self.layer.iter_layer())), 3)
+
+        # nothing missing: no new layer
+        con._add_missing_layers(map_feat)
+        self.assertEqual(len(list(self.layer.iter_layer())), 3)
+
+    def test_load_from_qnode_cache(self):
+        self.layer.add_ext_layers(self.LST_GEOM_IDX)
+        qnode = self.layer.qgroups["main"]
+        cache = qnode.customProperty("xyz-hub-layers-cache")
+
+        obj = XYZLayer.load_from_qnode(qnode)
+        self.assertEqual(self._get_layer_recs(obj), self._get_layer_recs(self.layer))
+        self.assertTrue(obj.has_layer(None, 0))
+        self.assertEqual(qnode.customProperty("xyz-hub-layers-cache"), cache)
+
+    def test_load_from_qnode_cache_no_geometry_key(self):
+        self.layer.add_ext_layers(self.LST_GEOM_IDX)
+        qnode = self.layer.qgroups["main"]
+        cache = qnode.customProperty("xyz-hub-layers-cache")
+        qnode.setCustomProperty("xyz-hub-layers-cache",
+            cache.replace("null", '"NoGeometry"'))
+
+        obj = XYZLayer.load_from_qnode(qnode)
+        self.assertTrue(obj.has_layer(None, 0))
+        self.assertFalse(obj.has_layer("NoGeometry", 0))
+        self.assertEqual(self._get_layer_recs(obj), self._get_layer_recs(self.layer))
+
+    def test_load_from_qnode_stale_cache(self):
+        self.layer.add_ext_layers(self.LST_GEOM_IDX)
+        qnode = self.layer.qgroups["main"]
+        removed = self.layer.get_layer("Polygon", 0)
+        removed_id = removed.id()
+        QgsProject.instance().removeMapLayer(removed)
+        self.layer.layers = [r for r in self.layer.layers if r.geom_str != "Polygon"]
+
+        # fallback to scan the group, then repair the cache
+        obj = XYZLayer.load_from_qnode(qnode)
+        self.assertFalse(obj.has_layer("Polygon", 0))
+        self.assertEqual(self._get_layer_recs(obj), self._get_layer_recs(self.layer))
+        cache = qnode.customProperty("xyz-hub-layers-cache")
+        self.assertNotIn(removed_id, cache)
+
+        obj = XYZLayer.load_from_qnode(qnode)
+        self.assertEqual(self._get_layer_recs(obj), self._get_layer_recs(self.layer))
+
+    def test_load_from_qnode_invalid_cache(self):
+        self.layer.add_ext_layers(self.LST_GEOM_IDX)
+        qnode = self.layer.qgroups["main"]
+        cache = qnode.customProperty("xyz-hub-layers-cache")
+        for txt in ["", "not json", "1", "[1, 2]", '[["Point", 0]]', '{"a": 1}']:
+            with self.subTest(cache=txt):
+                if txt: qnode.setCustomProperty("xyz-hub-layers-cache", txt)
+                else: qnode.removeCustomProperty("xyz-hub-layers-cache")
+
+                obj = XYZLayer.load_from_qnode(qnode)
+                self.assertEqual(
+                    sorted(self._get_layer_recs(obj), key=str),
+                    sorted(self._get_layer_recs(self.layer), key=str))
+                self.assertTrue(qnode.customProperty("xyz-hub-layers-cache"))
+        qnode.setCustomProperty("xyz-hub-layers-cache", cache)
+
+    def _get_layer_recs(self, layer):
+        return [(r.geom_str, r.idx, r.vlayer.id()) for r in layer.layers]
+    def _get_gpkg_tables(self, vlayer, sql="SELECT table_name FROM gpkg_contents"):
+        fname = vlayer.source().split("|")[0]
+        conn = sqlite3.connect(fname)
+        try:
+            return sorted(r[0] for r in conn.execute(sql))
+        finally:
+            conn.close()
+    def _add_feat(self, vlayer, lst_xyz_id, with_geom=True):
+        lst_feat = list()
+        for i, xyz_id in enumerate(lst_xyz_id):
+            ft = QgsFeature(vlayer.fields())
+            ft.setAttribute(parser.QGS_XYZ_ID, xyz_id)
+            if with_geom:
+                ft.setGeometry(QgsGeometry.fromPointXY(QgsPointXY(i, i)))
+            lst_feat.append(ft)
+        ok, _ = vlayer.dataProvider().addFeatures(lst_feat)
+        self.assertTrue(ok)
+    def _get_xyz_ids(self, vlayer):
+        return sorted(ft.attribute(parser.QGS_XYZ_ID) for ft in vlayer.getFeatures())
+
+    def remove_layer(self, layer: XYZLayer):
+        QgsProject.instance().removeMapLayers([v.id() for v in layer.iter_layer()])
+        group = layer.qgroups.get("main")
+        if group is not None:
+            QgsProject.instance().layerTreeRoot().removeChildNode(group)
+    def new_layer(self, unique=None):
+        conn_info = SpaceConnectionInfo.from_dict(dict(space_id="id", token="token"))
+        meta = dict(title="title", id="id")
+        return XYZLayer(conn_info, meta, tags="unittest",
+            unique=unique or random.randint(1, 10**9))
+
+
+if __name__ == "__main__":
+    unittest.main()